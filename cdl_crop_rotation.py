@@ -12,20 +12,41 @@ then calculates the dominant crop/cover within the AOI for each year and stores
 results to a csv
 """
 import os
+import functools
+import concurrent.futures as cf
 import requests as req
-import xml.etree.ElementTree as et
+import re
+import html
 import rasterio as rio
+import rasterio.errors
 import rasterio.mask as mask
+from rasterio.io import MemoryFile
 import numpy as np
 import geopandas as gpd
 import pandas as pd
+import pyproj
+import shapely
+from shapely.geometry import mapping
+
+## numba is optional, it only speeds up counting cells for very large AOIs
+try:
+    import numba
+except ImportError:
+    numba = None
+
+## fast-histogram is optional too, used for counting if numba isn't around
+try:
+    from fast_histogram import histogram1d
+except ImportError:
+    histogram1d = None
 
 #### USER Defined variables ###################################################
-## if true, will delete CDL raster after computation is done
+## if true, CDL rasters are only kept in memory and not written to disk
 clean_up = False
 
-## shape file to mask raster in assessing dominant crop, this is fld bdry/AOI
-clip_file = 'test_area.shp'
+## shape files to mask raster in assessing dominant crop, these are fld bdry/AOIs
+## each one gets its own results csv, more than one are run in parallel
+clip_files = ['test_area.shp']
 
 ## beginning year
 beg_yr = 2011
@@ -33,6 +54,9 @@ beg_yr = 2011
 ## number of years to fetch data for
 num_yrs = 4
 
+## if true, always download rasters even if they are already in the raster dir
+refresh = False
+
 #### END USER Defined variables, edit below at your own risk ##################
 
 ## set working dir
@@ -47,137 +71,391 @@ base_url = 'https://nassgeodata.gmu.edu/axis2/services/CDLService/GetCDLFile'
 ## csv containing cdl codes, names and rgb vals
 cmap_file = 'cdl_map.csv'
 
-## container for results
-results = []
+cdl_yrs = [2009, 2024]
 
-## error switch
-err = False
+## max number of years to fetch at once, keep this low to be nice to the NASS server
+max_workers = 4
 
-cdl_yrs = [2009, 2024]
+## raster size in MB above which the GDAL block cache is raised to fit the whole
+## raster while masking, rasterizing the AOI falls back to a slow path if it 
+## doesn't fit, GDAL's own cache (~5% of RAM) is left alone for smaller rasters
+gdal_cachemax = 256
 
-## check if the proposed timeframe and number of years is within CDL params
-if num_yrs > cdl_yrs[1] - cdl_yrs[0]:
-    num_yrs = cdl_yrs[1] - cdl_yrs[0]
-
-if beg_yr < cdl_yrs[0]:
-    beg_yr = cdl_yrs[0]
-    
-if beg_yr > cdl_yrs[1]:
-    beg_yr = cdl_yrs[1] - num_yrs
-    
-## check directory structure and contents
-for d in dirs:
-    if not os.path.exists(os.path.join(cwd, d)):
-        ## needs to have a geometry to clip from in the geometry folder
-        if d == dirs[0]:
-            err = True
-        ## make some dirs to store stuff in
-        else:
-            os.makedirs(os.path.join(cwd, d))
-            
-if not os.path.exists(os.path.join(cwd, 'geometry', clip_file)): 
-    err = True           
+## fewest cells before counting with numba is worth its JIT compile, a normal
+## field is a few thousand cells and np.bincount does that in microseconds
+numba_min_cells = 10_000_000
 
-if err:
-    print("""Geometry directory or AOI shape file not found.
-             Ensure working directory has a geometry directory with the
-             specified shapefile""")
+## (connect, read) timeouts in seconds for requests to the CDL server
+timeout = (10, 300)
 
-else:
-    ## read in the cdl map
-    cmap = pd.read_csv(os.path.join(cwd, 'cdl_map.csv'))
+## pulls the download url out of the CDL service's xml response, it's a tiny
+## envelope with one field we care about so no need for a full xml parser
+_url_re = re.compile(rb'<(?:\w+:)?returnURL>([^<]+)</(?:\w+:)?returnURL>')
 
-    ## read in geometry
-    clip_shp = gpd.read_file(os.path.join(cwd, 'geometry', clip_file))
+## one session for all requests so connections are kept alive and reused, 
+## retry a few times if the server has a hiccup
+session = req.Session()
+session.mount('https://', req.adapters.HTTPAdapter(
+    pool_connections=8, pool_maxsize=8,
+    max_retries=req.adapters.Retry(total=3, backoff_factor=1.0,
+                                   status_forcelist=[500, 502, 503, 504])))
 
-    ## Coords must be 5070, Albers Equal Area Conic
-    clip_shp = clip_shp.to_crs("EPSG:5070")
+@functools.lru_cache(maxsize=16)
+def _cached_transformer(src_crs_wkt, dst_crs):
+    """
+    Builds a pyproj transformer once per crs pair, building them is slow
+    """
+    return pyproj.Transformer.from_crs(src_crs_wkt, dst_crs, always_xy=True)
 
-    ## set bounding box values for the geometry
-    bb = [int(b) for b in clip_shp.loc[0].geometry.bounds]
+def to_crs(shp, dst_crs):
+    """
+    Reprojects the geometry of a geodataframe using a cached transformer
     
-    ## loop over years 
-    for yr in [beg_yr+i for i in range(num_yrs)]:
-        
-        print("processing data for {0}".format(yr))
-        
-        ## format bounding box string for api params
-        bb_str = '{0},{1},{2},{3}'.format(*bb)
-        
-        ## dict for api params
-        params = {'year':yr, 'bbox':bb_str}
+    returns a new geodataframe in dst_crs
+    """
+    ## can't reproject without knowing where we're starting from
+    if shp.crs is None:
+        raise ValueError("""AOI shape file has no coordinate system.
+                 Ensure the shapefile has a .prj file alongside it""")
+    
+    tfm = _cached_transformer(shp.crs.to_wkt(), dst_crs)
+    
+    ## transform all the geometries in one vectorized call and keep the 
+    ## original index
+    geoms = gpd.GeoSeries(shapely.transform(shp.geometry.values, tfm.transform, interleaved=False),
+                          index=shp.index, crs=dst_crs)
+    
+    return shp.set_geometry(geoms)
+
+if numba is not None:
+    @numba.njit(parallel=True, cache=True)
+    def _count256(vals, n_chunks):
+        """
+        Counts uint8 values into 256 bins, each of n_chunks threads fills its
+        own histogram over a chunk of the array and they're summed at the end
+        """
+        size = (vals.size + n_chunks - 1) // n_chunks
+        out = np.zeros((n_chunks, 256), np.int64)
+        for t in numba.prange(n_chunks):
+            for i in range(t*size, min((t+1)*size, vals.size)):
+                out[t, vals[i]] += 1
+        return out.sum(axis=0)
+
+def count_codes(vals):
+    """
+    Counts the cells of each cdl code in a flat uint8 array, uses the numba
+    kernel for very large arrays if numba is installed, otherwise 
+    fast-histogram, then np.bincount
+    
+    returns an array of 256 counts, one per code
+    """
+    if numba is not None and vals.size > numba_min_cells:
+        ## thread count comes from python, looking it up inside the kernel
+        ## keeps numba from caching the compiled kernel to disk
+        return _count256(vals, numba.get_num_threads())
+    
+    ## unit width bins over 0-256, comes back as floats
+    if histogram1d is not None:
+        return histogram1d(vals, bins=256, range=(0, 256)).astype(np.int64)
+    
+    return np.bincount(vals, minlength=256)
+
+def is_raster(path):
+    """
+    Checks that a file on disk opens as a raster
+    
+    returns True if it does, False if not
+    """
+    try:
+        with rio.open(path):
+            return True
+    except rio.errors.RasterioIOError:
+        return False
+
+def download(session, url, out_path=None, chunk_size=1024*1024):
+    """
+    Streams a file from url to out_path, or into a rasterio MemoryFile if no
+    path is given, so the whole response is never held as one bytes object
+    
+    returns out_path, or the MemoryFile which the caller is responsible for
+    closing
+    """
+    with session.get(url, stream=True, timeout=timeout) as r:
+        r.raise_for_status()
         
-        ## tell api to clip some data for our bounding box and store it on the server
-        dat = req.get('https://nassgeodata.gmu.edu/axis2/services/CDLService/GetCDLFile', params)
+        ## not keeping it, hold the raster in memory only
+        if out_path is None:
+            memfile = MemoryFile()
+            try:
+                for chunk in r.iter_content(chunk_size):
+                    memfile.write(chunk)
+            except Exception:
+                memfile.close()
+                raise
+            return memfile
         
-        ## get the url of the stored data
-        root = et.fromstring(dat.content)
-        dl_url = root.findtext(".//returnURL")
+        ## write each chunk to a temp file on disk so a partial download never
+        ## looks like a cached raster, the pid keeps AOI processes sharing a 
+        ## bounding box off each other's file
+        part_path = '{0}.{1}.part'.format(out_path, os.getpid())
+        try:
+            with open(part_path, 'wb') as dest:
+                for chunk in r.iter_content(chunk_size):
+                    dest.write(chunk)
+                    
+            ## make sure we got a raster and not an error page before caching it
+            if not is_raster(part_path):
+                raise ValueError("Download from {0} is not a raster".format(url))
+            
+        ## don't leave partial or bad downloads lying around
+        except Exception:
+            if os.path.exists(part_path):
+                os.remove(part_path)
+            raise
         
-        ## download the stored data (raster for our area and this year)
-        dat = req.get(dl_url)
+    ## download finished, swap the complete file into place
+    os.replace(part_path, out_path)
+    
+    return out_path
+
+def get_return_url(session, yr, bb_api):
+    """
+    Asks the CDL service to clip a year of data to the bounding box and 
+    store it on the server
+    
+    returns the url of the stored raster
+    """
+    ## dict for api params
+    params = {'year':yr, 'bbox':bb_api}
+    
+    ## tell api to clip some data for our bounding box and store it on the server
+    dat = session.get(base_url, params=params, timeout=timeout)
+    
+    ## get the url of the stored data
+    match = _url_re.search(dat.content)
+    if match is None:
+        raise ValueError("No returnURL in CDL response for {0}".format(yr))
+    
+    ## undo any xml escaping (&amp; etc) the parser would have handled
+    return html.unescape(match.group(1).decode())
+
+def fetch_year(yr, bb_api, bb_file, clean_up, refresh, session):
+    """
+    Fetches the CDL raster for one year over the bounding box of the AOI, 
+    and saves a copy to the raster dir unless clean_up is set. A raster 
+    already in the raster dir for this year and bounding box is reused 
+    unless refresh is set
+    
+    returns the path of the raster on disk, or when clean_up is set the 
+    downloaded raster as a MemoryFile, caller is responsible for closing it
+    """
+    ## path the CDL data for this year and this bounding box is stored at
+    out_path  = os.path.join(os.getcwd(), 'raster', "cdl_{0}_{1}.tif".format(yr, bb_file))
+    
+    ## reuse a prior download as long as it still opens, otherwise fetch it again
+    if not refresh and os.path.exists(out_path) and is_raster(out_path):
+        print("using cached data for {0}".format(yr))
+        return out_path
+    
+    print("fetching data for {0}".format(yr))
+    
+    ## url of the raster clipped to our bounding box on the server
+    dl_url = get_return_url(session, yr, bb_api)
+    
+    ## no copy of the raster on disk unless we want to keep it
+    if clean_up:
+        out_path = None
         
-        ## format bb string for file storage (i don't like commas in file names)
-        bb_str = '{0}_{1}_{2}_{3}'.format(*bb)
+    ## download the stored data (raster for our area and this year)
+    return download(session, dl_url, out_path)
+
+def dominant_crop(src, clip_geoms, code_to_name):
+    """
+    Masks a CDL raster to the AOI polygon and finds the dominant crop/cover,
+    src is either a path to a raster or a MemoryFile
+    
+    returns the crop name
+    """
+    ## rasters we aren't keeping are opened in memory, the rest from disk
+    with (src.open() if isinstance(src, MemoryFile) else rio.open(src)) as ras:
         
-        ## make a path to store the CDL data for this year and this bounding box
-        out_path  = os.path.join(os.getcwd(), 'raster', "cdl_{0}_{1}.tif".format(yr, bb_str))
+        ## size of the raster in bytes, the cache needs to hold all of it
+        ras_bytes = ras.width * ras.height * np.dtype(ras.dtypes[0]).itemsize * ras.count
         
-        ## delete data if it exists, could save it but refresh it in case old is corrupt
-        if os.path.exists(out_path):
-            os.remove(out_path)
+        ## raise the cache to fit big rasters, rasterio takes an int as bytes,
+        ## otherwise leave GDAL's setting alone
+        env = {}
+        if ras_bytes > gdal_cachemax * 2**20:
+            env['GDAL_CACHEMAX'] = ras_bytes + 2**20
             
-        ## write the cdl raster
-        with open(out_path, 'wb') as dest:
-            dest.write(dat.content)
-            dest.close()
+        #mask it to the actual extent of the polygon not the bounding box, keep
+        #it as a masked array so cells outside the polygon are flagged not filled
+        with rio.Env(**env):
+            dat, xfm = mask.mask(ras, clip_geoms, crop=True, indexes=1,
+                                 filled=False, all_touched=False)
             
-        ## reopen it for reading and analysis
-        with rio.open(out_path, 'r') as ras:
-            
-            #mask it to the actual extent of the polygon not the bounding box
-            dat, xfm = mask.mask(ras, clip_shp.geometry, crop=True)
+    ## only the cells inside the polygon, as contiguous uint8 since cdl codes 
+    ## are 0-255 and some rasterio paths upcast when nodata is set, 1 byte a
+    ## cell keeps the count step light on memory
+    vals = np.ascontiguousarray(dat.compressed(), dtype=np.uint8)
+    
+    ## count the cells of every cdl code in a single pass, a 256 bin count
+    ## covers all of them
+    counts = count_codes(vals)
+    
+    ## dominant cover is the code with the most cells in our AOI polygon, skip
+    ## bin 0 (background) in case the raster has no nodata set
+    crop_max = int(counts[1:].argmax()) + 1
+    
+    ## nothing but background in the AOI
+    if counts[crop_max] == 0:
+        crop_max = 0
             
-            ## close the raster
-            ras.close()
+    ## get the name (string) of the crop
+    return code_to_name.get(crop_max, 'Unknown')
+
+def process_aoi(clip_file, beg_yr, num_yrs, clean_up, refresh, fetch_workers=max_workers):
+    """
+    Finds the dominant crop/cover in an AOI shapefile for each year and 
+    writes the rotation to a csv in the results dir, fetching at most 
+    fetch_workers years at once
+    
+    returns a data frame of year and crop
+    """
+    ## read in the cdl map
+    cmap = pd.read_csv(os.path.join(cwd, cmap_file))
+    
+    ## build a code -> name lookup once instead of searching the table every year
+    code_to_name = dict(zip(cmap['Codes'].astype(int), cmap['Current Class Names']))
+
+    ## read in geometry
+    clip_shp = gpd.read_file(os.path.join(cwd, 'geometry', clip_file))
+
+    ## Coords must be 5070, Albers Equal Area Conic
+    clip_shp = to_crs(clip_shp, "EPSG:5070")
+
+    ## set bounding box values for the geometry
+    bb = tuple(map(int, clip_shp.geometry.iloc[0].bounds))
+    
+    ## format bounding box strings once, one for api params and one for file 
+    ## storage (i don't like commas in file names)
+    bb_api = '{0},{1},{2},{3}'.format(*bb)
+    bb_file = '{0}_{1}_{2}_{3}'.format(*bb)
+    
+    ## geojson-like dicts of the AOI for masking, done once and not per year
+    clip_geoms = [mapping(g) for g in clip_shp.geometry]
+    
+    ## years to fetch data for
+    years = [beg_yr+i for i in range(num_yrs)]
+    
+    ## fetches for each year, keyed back to the year they're for
+    futures = {}
+    
+    ## dominant crop for each year
+    crops = {}
+    
+    try:
+        ## fetch all the years at once, most of the time is spent waiting on 
+        ## the server so threads are plenty here
+        with cf.ThreadPoolExecutor(max_workers=min(num_yrs, fetch_workers)) as ex:
+            futures = {ex.submit(fetch_year, y, bb_api, bb_file, clean_up, refresh, session): y
+                       for y in years}
             
-            ## delete the cdl raster if we don't need it any longer
-            if clean_up:
-                os.remove(out_path)
+            ## find the dominant crop for each year as soon as its raster is in,
+            ## so in memory rasters (clean_up) are freed one at a time rather
+            ## than all being held until the last year arrives, this raises 
+            ## if any year failed to fetch
+            for f in cf.as_completed(futures):
+                yr, src = futures[f], f.result()
                 
-            ## get unique cell values
-            crops = np.unique(dat[np.where(dat!=0)])
-            
-            ## instantiate some vars to keep track of dominant cover
-            crop_max = 0
-            max_cnt = 0
-            
-            ## loop over each crop in the raster
-            for c in crops:
+                print("processing data for {0}, {1}".format(clip_file, yr))
                 
-                ## get number of cells with this crop in our AOI polygon
-                cnt = np.sum(np.where(dat==c,1,0))
+                crops[yr] = dominant_crop(src, clip_geoms, code_to_name)
                 
-                ## check if this crop comprises a larger area than the prior max 
-                if cnt > max_cnt:
-                    crop_max = c
-                    max_cnt = cnt
+                ## paths to rasters on disk don't need closing
+                if isinstance(src, MemoryFile):
+                    src.close()
                     
-            ## get the name (string) of the crop
-            crop_name = cmap.loc[cmap.Codes==crop_max]['Current Class Names'].values[0]
-            
-            ## store the year and the crop to the results list
-            results.append([yr, crop_name])
-            
+    finally:
+        ## free any in memory rasters left over if a year failed
+        for f in futures:
+            if f.done() and not f.cancelled() and f.exception() is None \
+                    and isinstance(f.result(), MemoryFile) and not f.result().closed:
+                f.result().close()
+                
+    ## back in year order
+    results = [[yr, crops[yr]] for yr in years]
+    
     ## store all results to a data frame
     results = pd.DataFrame(results, columns=['year', 'crop'])
     
+    ## name of the AOI, AOIs can share a bounding box so it goes in the csv name
+    aoi_name = os.path.splitext(os.path.basename(clip_file))[0]
+    
     ## path to store csv of results
-    out_path  = os.path.join(cwd, 'results', "rotation_{0}_{1}_{2}.csv".format(beg_yr, yr, bb_str))
+    out_path  = os.path.join(cwd, 'results', "rotation_{0}_{1}_{2}_{3}.csv".format(aoi_name, beg_yr, years[-1], bb_file))
     
     ## remove prior output just in case its corrupt
     if os.path.exists(out_path):
         os.remove(out_path)
         
     ## write csv
-    results.to_csv(out_path, index=False) 
\ No newline at end of file
+    results.to_csv(out_path, index=False)
+    
+    return results
+
+## only run when called as a script, worker processes import this module too
+if __name__ == '__main__':
+    
+    ## error switch
+    err = False
+    
+    ## check if the proposed timeframe and number of years is within CDL params
+    if num_yrs > cdl_yrs[1] - cdl_yrs[0]:
+        num_yrs = cdl_yrs[1] - cdl_yrs[0]
+    
+    if beg_yr < cdl_yrs[0]:
+        beg_yr = cdl_yrs[0]
+        
+    if beg_yr > cdl_yrs[1]:
+        beg_yr = cdl_yrs[1] - num_yrs
+        
+    ## check directory structure and contents
+    for d in dirs:
+        if not os.path.exists(os.path.join(cwd, d)):
+            ## needs to have a geometry to clip from in the geometry folder
+            if d == dirs[0]:
+                err = True
+            ## make some dirs to store stuff in
+            else:
+                os.makedirs(os.path.join(cwd, d))
+                
+    for clip_file in clip_files:
+        if not os.path.exists(os.path.join(cwd, 'geometry', clip_file)): 
+            err = True           
+    
+    if err:
+        print("""Geometry directory or AOI shape file not found.
+                 Ensure working directory has a geometry directory with the
+                 specified shapefiles""")
+    
+    ## a single AOI doesn't need the overhead of extra processes
+    elif len(clip_files) == 1:
+        process_aoi(clip_files[0], beg_yr, num_yrs, clean_up, refresh)
+        
+    ## AOIs are independent and the masking/counting is cpu bound, so give 
+    ## each one its own process
+    else:
+        n = len(clip_files)
+        
+        ## every process fetches too, so no more processes than max_workers and
+        ## max_workers split between them keeps the load on the NASS server 
+        ## where it would be for a single AOI
+        n_procs = min(n, os.cpu_count() or 1, max_workers)
+        fetch_workers = max(1, max_workers // n_procs)
+        
+        with cf.ProcessPoolExecutor(max_workers=n_procs) as ex:
+            
+            ## each AOI writes its own csv, list() just waits on them so errors surface
+            list(ex.map(process_aoi, clip_files, [beg_yr]*n, [num_yrs]*n, [clean_up]*n,
+                        [refresh]*n, [fetch_workers]*n))